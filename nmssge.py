@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 
-import collections.abc
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import io
 import json
+import marshal
+import math
+import mmap
+import os
+import struct
 import sys
+import weakref
 from pathlib import Path
 
 import lz4.block
+import orjson
+
+try:
+	import msgpack
+except ImportError:  # optional, only needed for packed savefiles
+	msgpack = None
 from PySide6.QtCore import *
 from PySide6.QtGui import *
 from PySide6.QtWidgets import *
@@ -15,83 +30,194 @@ data = [0]
 
 """Savegame (de)compressor and (de|en)coder."""
 
-decode_mapping: dict[str, str] = json.loads(Path(__file__).resolve().with_suffix('.json').read_text())
-encode_mapping: dict[str, str] = {v: k for k, v in decode_mapping.items()}
+
+@functools.cache
+def get_mappings() -> tuple[dict[str, str], dict[str, str]]:
+	"""Load decode and encode key mappings, cached in marshal format next to the json file."""
+	json_file = Path(__file__).resolve().with_suffix('.json')
+	cache_file = json_file.with_suffix('.cache')
+	try:
+		if cache_file.stat().st_mtime >= json_file.stat().st_mtime:
+			return marshal.loads(cache_file.read_bytes())
+	except (OSError, EOFError, ValueError, TypeError):
+		pass
+	decode_mapping: dict[str, str] = orjson.loads(json_file.read_bytes())
+	mappings = decode_mapping, {v: k for k, v in decode_mapping.items()}
+	try:
+		cache_file.write_bytes(marshal.dumps(mappings))
+	except OSError:
+		pass
+	return mappings
+
+
+def nonfinite(src: any) -> bool:
+	"""Check nested data for NaN and infinite floats."""
+	stack = [src]
+	while stack:
+		src = stack.pop()
+		if type(src) is dict:
+			stack.extend(src.values())
+		elif type(src) is list:
+			stack.extend(src)
+		elif isinstance(src, float) and not math.isfinite(src):
+			return True
+	return False
+
+
+def json_dumps(src: any, indent: bool = False) -> bytes:
+	"""Serialize to utf-8 json, using the stdlib where orjson would fail or write NaN and Infinity as null."""
+	try:
+		out = orjson.dumps(src, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+		if b'null' not in out or not nonfinite(src):
+			return out
+	except orjson.JSONEncodeError:  # integers exceeding 64 bit
+		pass
+	return json.dumps(src, indent=2 if indent else None, separators=(',', ': ' if indent else ':'), ensure_ascii=False).encode()
+
+
+def remap(src: any, mapping: dict[str, str], strict: bool = False) -> any:
+	"""Convert keys of nested dicts and lists without recursion."""
+	getitem, get = mapping.__getitem__, mapping.get
+	dict_, list_, tuple_, type_ = dict, list, tuple, type  # locals for the hot loop
+	root = [src]
+	stack = [(root, 0, src)] if type_(src) is dict_ or type_(src) is list_ or type_(src) is tuple_ else []
+	push, pop = stack.append, stack.pop
+	while stack:
+		parent, key, src = pop()
+		if parent[key] is not src:  # overwritten by a later key renamed to the same name
+			continue
+		if type_(src) is dict_:
+			out = {}
+			for k, v in src.items():
+				k = getitem(k) if strict else get(k, k)
+				out[k] = v
+				t = type_(v)
+				if t is dict_ or t is list_ or t is tuple_:
+					push((out, k, v))
+		else:
+			out = list_(src)
+			for i, v in enumerate(out):
+				t = type_(v)
+				if t is dict_ or t is list_ or t is tuple_:
+					push((out, i, v))
+		parent[key] = out
+	return root[0]
 
 
 def decode(src: str, strict: bool = False) -> dict:
 	"""Decode from json."""
+	mapping = get_mappings()[0]
+	get = mapping.get
 
 	def decoder(src: list[tuple[any, any]]) -> dict:
 		"""Json dict hook."""
-		return {decode_mapping[k] if strict or k in decode_mapping else k: v for k, v in src}
+		return {mapping[k]: v for k, v in src} if strict else {get(k, k): v for k, v in src}
 
 	return json.loads(src, object_pairs_hook=decoder)
 
 
 def encoder(src: any, strict: bool = False) -> any:
-	"""Convert keys recursively."""
-	if isinstance(src, collections.abc.Mapping):
-		return {encode_mapping[k] if strict or k in encode_mapping else k: encoder(v, strict=strict) for k, v in src.items()}
-	if isinstance(src, (tuple, list)):
-		return [encoder(v, strict=strict) for v in src]
-	return src
+	"""Convert keys for encoding."""
+	return remap(src, get_mappings()[1], strict=strict)
 
 
-def encode(src: any, strict: bool = False) -> str:
-	"""Encode to json."""
-	return json.dumps(encoder(src, strict=strict), separators=(',', ':'), ensure_ascii=False)
+def encode(src: any, strict: bool = False) -> bytes:
+	"""Encode to utf-8 json."""
+	return json_dumps(encoder(src, strict=strict))
 
 
-def to_json(data: bytes) -> str:
-	"""Convert to valid json."""
-	return data.strip(b'\x00').decode('iso-8859-15')
+def decode_packed(src: bytes, strict: bool = False) -> dict:
+	"""Decode from msgpack."""
+	if msgpack is None:
+		raise ImportError('packed savefiles (.hgp) require msgpack')
+	return remap(msgpack.unpackb(src, raw=False), get_mappings()[0], strict=strict)
 
 
-def from_json(data: str) -> bytes:
-	"""Convert to bytes."""
-	return data.encode('iso-8859-15') + b'\x00'
+def encode_packed(src: any, strict: bool = False) -> bytes:
+	"""Encode to msgpack."""
+	if msgpack is None:
+		raise ImportError('packed savefiles (.hgp) require msgpack')
+	try:
+		return msgpack.packb(encoder(src, strict=strict), use_bin_type=True)
+	except OverflowError as err:
+		raise ValueError('packed savefiles (.hgp) cannot store integers exceeding 64 bit') from err
 
 
-def uint32(data: bytes) -> int:
-	"""Convert 4 bytes to a little endian unsigned integer."""
-	return int.from_bytes(data, byteorder='little', signed=False) & 0xffffffff
+def to_json(data: bytes) -> str:
+	"""Convert to valid json, ascii saves use the faster but identical latin-1 codec."""
+	end = len(data)
+	while end and data[end - 1] == 0:
+		end -= 1
+	return str(memoryview(data)[:end], 'latin-1' if data.isascii() else 'iso-8859-15')
 
 
-def byte4(data: int) -> bytes:
-	"""Convert unsigned 32 bit integer to 4 bytes."""
-	return data.to_bytes(4, byteorder='little', signed=False)
+def from_json(data: bytes) -> bytes:
+	"""Convert utf-8 json to bytes, ascii json is already in savegame encoding."""
+	if not data.isascii():
+		data = data.decode().encode('iso-8859-15')
+	return data + b'\x00'
 
 
-def decompress(data: bytes) -> bytes:
+block_header = struct.Struct('<IIII')
+
+
+def decompress(data: bytes | mmap.mmap) -> bytes:
 	"""Decompresses the given save bytes."""
-	size = len(data)
-	din = io.BytesIO(data)
-	out = bytearray()
-	while din.tell() < size:
-		magic = uint32(din.read(4))
-		if magic != 0xfeeda1e5:
-			print("Invalid Block, bad file (already decompressed?)")
-			return data
-		compressedSize = uint32(din.read(4))
-		uncompressedSize = uint32(din.read(4))
-		din.seek(4, 1)  # skip 4 bytes
-		out += lz4.block.decompress(din.read(compressedSize), uncompressed_size=uncompressedSize)
-	return out
+	mv = memoryview(data)
+	size = len(mv)
+	pos = 0
+	blocks = []
+	sizes = []
+	unpack_header = block_header.unpack_from
+	header_size = block_header.size
+	try:
+		while pos < size:
+			try:
+				magic, compressedSize, uncompressedSize, _ = unpack_header(mv, pos)
+			except struct.error:
+				magic = None
+			if magic != 0xfeeda1e5:
+				print("Invalid Block, bad file (already decompressed?)")
+				return bytes(data)
+			pos += header_size
+			blocks.append(mv[pos:pos + compressedSize])
+			sizes.append(uncompressedSize)
+			pos += compressedSize
+		with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as pool:
+			return b''.join(pool.map(lambda block, size: lz4.block.decompress(block, uncompressed_size=size), blocks, sizes))
+	finally:
+		# release views explicitly, a traceback would otherwise keep an mmap input from closing
+		for block in blocks:
+			block.release()
+		mv.release()
+
+
+def compress_to(data: bytes, fout: io.BufferedIOBase):
+	"""Compresses the given save bytes into a binary file, keeping only a few blocks in memory."""
+	chunk_size = 0x80000
+	workers = os.cpu_count() or 1
+	mv = memoryview(data)
+	pending = collections.deque()
+
+	def write_block(size: int, block: concurrent.futures.Future):
+		block = block.result()
+		fout.write(block_header.pack(0xfeeda1e5, len(block), size, 0))
+		fout.write(block)
+
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		for i in range(0, len(mv), chunk_size):
+			pending.append((min(chunk_size, len(mv) - i), pool.submit(lz4.block.compress, mv[i:i + chunk_size], store_size=False)))
+			if len(pending) > 2 * workers:
+				write_block(*pending.popleft())
+		while pending:
+			write_block(*pending.popleft())
 
 
 def compress(data: bytes) -> bytes:
 	"""Compresses the given save bytes."""
-	chunk_size = 0x80000
-	out = bytearray()
-	for din in iter(data[i:i + chunk_size] for i in range(0, len(data), chunk_size)):
-		block = lz4.block.compress(din, store_size=False)
-		out += byte4(0xfeeda1e5)
-		out += byte4(len(block))
-		out += byte4(len(din))
-		out += byte4(0)
-		out += block
-	return out
+	out = io.BytesIO()
+	compress_to(data, out)
+	return out.getvalue()
 
 
 """File picker logic."""
@@ -100,9 +226,21 @@ def compress(data: bytes) -> bytes:
 def file_save(file_name: Path):
 	"""Save data struct to file, autodetecting format."""
 	if file_name.suffix == '.json':
-		file_name.write_text(json.dumps(data[0], separators=(',', ':'), ensure_ascii=False))
+		file_name.write_bytes(json_dumps(data[0]))
 	else:
-		file_name.write_bytes(compress(from_json(encode(data[0]))))
+		try:
+			payload = encode_packed(data[0]) if file_name.suffix == '.hgp' else from_json(encode(data[0]))
+		except (ImportError, ValueError) as err:
+			print('save error:', err)
+			return
+		tmp_name = file_name.with_name(file_name.name + '.tmp')
+		try:
+			with open(tmp_name, 'wb', buffering=1 << 20) as fout:
+				compress_to(payload, fout)
+			os.replace(tmp_name, file_name)
+		except BaseException:
+			tmp_name.unlink(missing_ok=True)
+			raise
 
 
 def cmd_save():
@@ -117,11 +255,18 @@ def cmd_save():
 def file_open(file_name: Path):
 	"""Load a file into data struct and init tree view"""
 	if file_name.suffix == '.json':
-		data[0] = json.loads(file_name.read_text())
+		try:
+			data[0] = json.loads(file_name.read_bytes())
+		except UnicodeDecodeError:  # json written by earlier versions in the locale encoding
+			data[0] = json.loads(file_name.read_text())
 	else:
-		data[0] = decode(to_json(decompress(file_name.read_bytes())))
+		with open(file_name, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			raw = decompress(mm)
+		data[0] = decode_packed(raw) if file_name.suffix == '.hgp' else decode(to_json(raw))
 	wnd.mTree.clear()
-	itm = tree_add('root', (data, 0), wnd.mTree)
+	txt_cache.clear()
+	with tree_frozen():
+		itm = tree_add('root', (data, 0), wnd.mTree)
 	itm.setExpanded(True)
 
 
@@ -134,6 +279,12 @@ def cmd_open():
 	fp.open()
 
 
+def file_picker_filter(name: str):
+	"""[Event] Default to the extension of the selected file type."""
+	suffix = name[name.rfind('(*') + 2:-1]
+	wnd.file_picker.setDefaultSuffix(suffix or '.hg')
+
+
 def file_picker_accept():
 	"""[Event] User has selected a file."""
 	fp: QFileDialog = wnd.file_picker
@@ -151,21 +302,39 @@ def file_picker_accept():
 
 """Tree and text logic."""
 
+tree_page_size = 1000
+txt_cache: weakref.WeakKeyDictionary[QTreeWidgetItem, str] = weakref.WeakKeyDictionary()
+
 
 def txt_save(e: QFocusEvent):
 	"""[Event] On focus loss, if user has changed json data, update data struct, tree and json display."""
 	if wnd.mText.contentChanged and wnd.mText.curItem:
 		wnd.mText.contentChanged = False
+		text = wnd.mText.toPlainText()
+		text_hash = hash(text)
+		if text_hash == wnd.mText.textHash:
+			return
 		try:
-			dat = json.loads(wnd.mText.toPlainText())
+			dat = json.loads(text)
 		except Exception as err:
 			print('json error:', repr(err))
 			return
 		itm: QTreeWidgetItem = wnd.mText.curItem
 		accessor = itm.data(0, Qt.ItemDataRole.UserRole)
+		cur = accessor[0][accessor[1]]
+		if isinstance(accessor[1], slice) and (type(dat) is not list or len(dat) != len(cur)):
+			print('page error: expected a list of', len(cur), 'items')
+			return
+		wnd.mText.textHash = text_hash
+		if dat is cur or (type(dat) is type(cur) and type(dat) not in (dict, list) and dat == cur):
+			return
 		accessor[0][accessor[1]] = dat
+		parent = itm
+		while parent is not None:
+			txt_cache.pop(parent, None)
+			parent = parent.parent()
 		tree_reset(itm, dat)
-		txt_display(dat)
+		txt_display(dat, itm)
 
 
 def txt_changed():
@@ -173,27 +342,54 @@ def txt_changed():
 	wnd.mText.contentChanged = True
 
 
-def txt_display(data: any):
-	"""Format and display json data."""
+def txt_display(data: any, itm: QTreeWidgetItem | None = None):
+	"""Format and display json data, reusing the text last formatted for itm."""
+	text = txt_cache.get(itm) if itm is not None else None
+	if text is None:
+		text = json_dumps(data, indent=True).decode()
+		if itm is not None:
+			txt_cache[itm] = text
 	wnd.mText.clear()
-	wnd.mText.setPlainText(json.dumps(data, indent='\t', ensure_ascii=False))
+	wnd.mText.setPlainText(text)
 	wnd.mText.contentChanged = False
+	wnd.mText.textHash = hash(text)
+
+
+@contextlib.contextmanager
+def tree_frozen():
+	"""Suspend tree repaints and signals during bulk inserts."""
+	wnd.mTree.setUpdatesEnabled(False)
+	blocked = wnd.mTree.blockSignals(True)
+	try:
+		yield
+	finally:
+		wnd.mTree.blockSignals(blocked)
+		wnd.mTree.setUpdatesEnabled(True)
 
 
 def tree_expand(item: QTreeWidgetItem):
-	"""[Event] Add child nodes when a node is first expanded."""
+	"""[Event] Add child nodes when a node is first expanded, paging long lists."""
 	if item.childCount() <= 0:
-		accessor = item.data(0, Qt.ItemDataRole.UserRole)
-		item_data = accessor[0][accessor[1]]
-		for k in item_data.keys() if isinstance(item_data, collections.abc.Mapping) else range(len(item_data)):
-			tree_add(k if isinstance(k, str) else f"[{repr(k)}]", (item_data, k), item)
+		item_data, key = item.data(0, Qt.ItemDataRole.UserRole)
+		if isinstance(key, slice):
+			keys = range(len(item_data))[key]
+		else:
+			item_data = item_data[key]
+			keys = item_data.keys() if type(item_data) is dict else range(len(item_data))
+		if type(item_data) is list and len(keys) > tree_page_size:
+			pages = (keys[i:i + tree_page_size] for i in range(0, len(keys), tree_page_size))
+			items = [tree_item(f"[{r.start}..{r.stop - 1}]", (item_data, slice(r.start, r.stop))) for r in pages]
+		else:
+			items = [tree_item(k if type(k) is str else f"[{repr(k)}]", (item_data, k)) for k in keys]
+		with tree_frozen():
+			item.addChildren(items)
 
 
 def tree_click(current: QTreeWidgetItem | None, previous: QTreeWidgetItem):
 	"""[Event] Display json when selected node is changed."""
 	if isinstance(current, QTreeWidgetItem):
 		accessor = current.data(0, Qt.ItemDataRole.UserRole)
-		txt_display(accessor[0][accessor[1]])
+		txt_display(accessor[0][accessor[1]], current)
 	wnd.mText.curItem = current
 
 
@@ -203,19 +399,29 @@ def tree_reset(itm: QTreeWidgetItem, data: any):
 		itm.setExpanded(False)
 	for n in reversed(range(itm.childCount())):
 		itm.removeChild(itm.child(n))
-	itm.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator if isinstance(data, (collections.abc.Mapping, list)) else QTreeWidgetItem.DontShowIndicatorWhenChildless)
+	itm.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator if type(data) is dict or type(data) is list else QTreeWidgetItem.DontShowIndicatorWhenChildless)
+
+
+def tree_item(name: str, accessor: tuple[any, any]) -> QTreeWidgetItem:
+	"""Create a node without adding it to the tree."""
+	itm = QTreeWidgetItem([name])
+	itm.setData(0, Qt.ItemDataRole.UserRole, accessor)
+	if type(accessor[1]) is slice:  # pages always hold a list, don't copy it for the type check
+		itm.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+	else:
+		data = accessor[0][accessor[1]]
+		if type(data) is dict or type(data) is list:
+			itm.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+	return itm
 
 
 def tree_add(name: str, accessor: tuple[any, any], parent: QTreeWidgetItem):
 	"""Add a node to tree list."""
-	itm = QTreeWidgetItem(parent)
-	itm.setText(0, name)
-	itm.setData(0, Qt.ItemDataRole.UserRole, accessor)
+	itm = tree_item(name, accessor)
 	if isinstance(parent, QTreeWidgetItem):
 		parent.addChild(itm)
 	else:
 		parent.addTopLevelItem(itm)
-	tree_reset(itm, accessor[0][accessor[1]])
 	return itm
 
 
@@ -246,18 +452,19 @@ def main(*args: str) -> int:
 	wnd.layData.addWidget(wnd.mText)
 
 	wnd.file_picker = QFileDialog(wnd)
-	wnd.file_picker.setDefaultSuffix('.hg')
-	wnd.file_picker.setNameFilters(['Hello Games SaveFile (*.hg)', 'Java Script Object Notation (*.json)', 'Any (*)'])
+	wnd.file_picker.setNameFilters(['Hello Games SaveFile (*.hg)', 'Hello Games packed SaveFile (*.hgp)', 'Java Script Object Notation (*.json)', 'Any (*)'])
 	wnd.file_picker.setViewMode(QFileDialog.Detail)
 
 	wnd.layData.setChildrenCollapsible(False)
 	wnd.mTree.setColumnCount(1)
 	wnd.mTree.setHeaderHidden(True)
+	wnd.mTree.setUniformRowHeights(True)
 	wnd.mText.setTabStopDistance(wnd.mText.fontMetrics().horizontalAdvance('\u2192'))
 	wnd.mText.setLineWrapMode(QPlainTextEdit.NoWrap)
 	wnd.setCentralWidget(wnd.mainWidget)
 
 	wnd.file_picker.accepted.connect(file_picker_accept)
+	wnd.file_picker.filterSelected.connect(file_picker_filter)
 	wnd.btnOpen.pressed.connect(cmd_open)
 	wnd.btnSave.pressed.connect(cmd_save)
 	wnd.mTree.currentItemChanged.connect(tree_click)
@@ -276,6 +483,7 @@ def main(*args: str) -> int:
 	wnd.file_picker.restoreState(settings.value('fp_state', QByteArray()))
 	wnd.file_picker.restoreGeometry(settings.value('fp_geometry', QByteArray()))
 	wnd.file_picker.selectNameFilter(settings.value('fp_filter', ''))
+	file_picker_filter(wnd.file_picker.selectedNameFilter())
 
 	wnd.show()
 